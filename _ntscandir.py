@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Enumeración de directorios en Windows mediante ``NtQueryDirectoryFileEx``
+(ntdll) a través de ``ctypes``.
+
+``os.scandir`` usa ``FindFirstFileW``/``FindNextFileW``, que sobre rutas
+UNC implican una transición al kernel por cada pocas entradas.
+``NtQueryDirectoryFileEx`` con la clase ``FileIdBothDirectoryInformation``
+devuelve en cada llamada todas las entradas que caben en un búfer de
+64 KB, con atributos, tamaño y fechas incluidos, de modo que el recorrido
+no necesita ningún ``os.stat`` adicional.
+
+El módulo sólo se puede importar en Windows 10 (1709) o posterior; en
+cualquier otro caso lanza ``ImportError`` y el escáner sigue usando
+``os.scandir``.
+"""
+
+import os
+import struct
+from typing import List, Optional, Tuple
+
+if os.name != "nt":
+    raise ImportError("_ntscandir sólo está disponible en Windows")
+
+import ctypes
+from ctypes import wintypes
+
+_kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+_ntdll = ctypes.WinDLL("ntdll")
+try:
+    _NtQueryDirectoryFileEx = _ntdll.NtQueryDirectoryFileEx
+except AttributeError:
+    raise ImportError("NtQueryDirectoryFileEx no disponible en esta versión de Windows") from None
+
+# Atributos de archivo y etiqueta de reparse de los enlaces simbólicos
+FILE_ATTRIBUTE_DIRECTORY: int = 0x10
+FILE_ATTRIBUTE_REPARSE_POINT: int = 0x400
+IO_REPARSE_TAG_SYMLINK: int = 0xA000000C
+
+_FILE_LIST_DIRECTORY = 0x0001
+_FILE_SHARE_ALL = 0x0007                 # lectura | escritura | borrado
+_OPEN_EXISTING = 3
+_FILE_FLAG_BACKUP_SEMANTICS = 0x02000000  # necesario para abrir directorios
+_INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+_FILE_ID_BOTH_DIRECTORY_INFORMATION = 37
+_SL_RESTART_SCAN = 0x1
+_STATUS_SUCCESS = 0x00000000
+_STATUS_NO_MORE_FILES = 0x80000006
+_STATUS_NO_SUCH_FILE = 0xC000000F
+# Estados con los que el servidor rechaza la clase de información (p. ej.
+# servidores SMB que no implementan FileIdBothDirectoryInformation)
+STATUS_INVALID_INFO_CLASS: int = 0xC0000003
+STATUS_NOT_SUPPORTED: int = 0xC00000BB
+STATUS_INVALID_PARAMETER: int = 0xC000000D
+
+# Tamaño del búfer de cada consulta
+_BUFFER_SIZE: int = 64 * 1024
+# Diferencia entre las épocas de FILETIME (1601) y Unix (1970) en unidades de 100 ns
+_EPOCH_DIFF: int = 116444736000000000
+# Parte fija de FILE_ID_BOTH_DIR_INFORMATION: NextEntryOffset, FileIndex,
+# CreationTime, LastAccessTime, LastWriteTime, ChangeTime, EndOfFile,
+# AllocationSize, FileAttributes, FileNameLength, EaSize
+_ENTRY_HEADER = struct.Struct("<IIqqqqqqIII")
+# Desplazamiento de FileName dentro de la estructura
+_NAME_OFFSET: int = 104
+
+
+class _IO_STATUS_BLOCK(ctypes.Structure):
+    _fields_ = [("Status", ctypes.c_void_p), ("Information", ctypes.c_size_t)]
+
+
+_CreateFileW = _kernel32.CreateFileW
+_CreateFileW.argtypes = [wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, ctypes.c_void_p,
+                         wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE]
+_CreateFileW.restype = wintypes.HANDLE
+_CloseHandle = _kernel32.CloseHandle
+_CloseHandle.argtypes = [wintypes.HANDLE]
+_CloseHandle.restype = wintypes.BOOL
+_NtQueryDirectoryFileEx.argtypes = [wintypes.HANDLE, wintypes.HANDLE, ctypes.c_void_p, ctypes.c_void_p,
+                                    ctypes.POINTER(_IO_STATUS_BLOCK), ctypes.c_void_p, wintypes.ULONG,
+                                    ctypes.c_int, wintypes.ULONG, ctypes.c_void_p]
+_NtQueryDirectoryFileEx.restype = wintypes.ULONG  # NTSTATUS tratado sin signo
+_RtlNtStatusToDosError = _ntdll.RtlNtStatusToDosError
+_RtlNtStatusToDosError.argtypes = [wintypes.ULONG]
+_RtlNtStatusToDosError.restype = wintypes.ULONG
+
+
+class NtScandirError(OSError):
+    """
+    ``OSError`` de ``scandir_nt``.  ``ntstatus`` es el NTSTATUS devuelto por
+    ``NtQueryDirectoryFileEx`` (``None`` si falló la apertura del
+    directorio) y ``entries`` las entradas leídas antes del fallo.
+    """
+    ntstatus: Optional[int]
+    entries: List[Tuple[str, int, int, int, int]]
+
+
+def _os_error(winerror: int, path: str, ntstatus: Optional[int] = None,
+              entries: Optional[List[Tuple[str, int, int, int, int]]] = None) -> NtScandirError:
+    """Construye un ``NtScandirError`` con ``winerror``, la ruta afectada y el estado NT."""
+    err = NtScandirError(None, ctypes.FormatError(winerror), path, winerror)
+    err.ntstatus = ntstatus
+    err.entries = entries if entries is not None else []
+    return err
+
+
+def scandir_nt(path: str) -> List[Tuple[str, int, int, int, int]]:
+    """
+    Lista el directorio ``path`` y devuelve tuplas ``(nombre, atributos,
+    tamaño, mtime_ns, reparse_tag)``, sin ``.`` ni ``..``.  ``mtime_ns`` se
+    obtiene de ``LastWriteTime`` con la misma conversión que ``os.stat``
+    (``st_mtime_ns``) y ``reparse_tag`` sólo es significativo si el
+    atributo ``FILE_ATTRIBUTE_REPARSE_POINT`` está activo.  Lanza
+    ``NtScandirError`` si el directorio no se puede abrir o leer; si la
+    lectura falla tras algún bloque, la excepción lleva las entradas ya
+    obtenidas.
+    """
+    handle = _CreateFileW(path, _FILE_LIST_DIRECTORY, _FILE_SHARE_ALL, None,
+                          _OPEN_EXISTING, _FILE_FLAG_BACKUP_SEMANTICS, None)
+    if handle is None or handle == _INVALID_HANDLE_VALUE:
+        raise _os_error(ctypes.get_last_error(), path)
+    entries: List[Tuple[str, int, int, int, int]] = []
+    buf = ctypes.create_string_buffer(_BUFFER_SIZE)
+    iosb = _IO_STATUS_BLOCK()
+    flags = _SL_RESTART_SCAN
+    try:
+        while True:
+            status = _NtQueryDirectoryFileEx(handle, None, None, None, ctypes.byref(iosb), buf,
+                                             _BUFFER_SIZE, _FILE_ID_BOTH_DIRECTORY_INFORMATION,
+                                             flags, None)
+            if status in (_STATUS_NO_MORE_FILES, _STATUS_NO_SUCH_FILE):
+                break
+            if status != _STATUS_SUCCESS:
+                raise _os_error(_RtlNtStatusToDosError(status), path, status, entries)
+            if not iosb.Information:
+                break
+            flags = 0
+            data = buf.raw
+            off = 0
+            while True:
+                (next_off, _, _, _, last_write, _, size, _,
+                 attrs, name_len, ea_size) = _ENTRY_HEADER.unpack_from(data, off)
+                start = off + _NAME_OFFSET
+                name = data[start:start + name_len].decode("utf-16-le", "surrogatepass")
+                if name != "." and name != "..":
+                    # Con FILE_ATTRIBUTE_REPARSE_POINT, EaSize contiene la etiqueta de reparse
+                    entries.append((name, attrs, size, (last_write - _EPOCH_DIFF) * 100, ea_size))
+                if not next_off:
+                    break
+                off += next_off
+    finally:
+        _CloseHandle(handle)
+    return entries
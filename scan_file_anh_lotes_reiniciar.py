@@ -23,8 +23,7 @@ Características principales:
   - Control de memoria: se invoca ``gc.collect()`` y ``fitz.TOOLS.store_shrink()``
     periódicamente (configurable con ``--gc-every`` y ``--store-shrink``)
     para liberar cachés internos y reducir el uso de memoria en procesados
-    masivos.  Se cierra cada documento PDF en un bloque ``finally`` y se
-    aplica ``store_shrink`` después de cada clasificación.
+    masivos.  Se cierra cada documento PDF en un bloque ``finally``.
   - Reanudación configurable: se puede reiniciar completamente (``--reset-state``)
     o ignorar el estado anterior (``--fresh``).  También se pueden
     seleccionar únicamente algunas subcarpetas (``--topdirs``) o
@@ -50,17 +49,20 @@ un subconjunto específico (sin alterar la ordenación predeterminada).
 """
 
 import os
-import csv
 import time
 import logging
 from logging.handlers import RotatingFileHandler
 import sqlite3
 import argparse
 import concurrent.futures
+import queue
+import threading
+import collections
+import functools
 import random
 import gc
 import errno
-from typing import Optional, Tuple, List, Dict, Iterable
+from typing import Optional, Tuple, List, Dict, Iterable, FrozenSet
 
 # Importación opcional de PyMuPDF.  Si no está disponible, las
 # clasificaciones de PDF se marcarán como indeterminadas.
@@ -69,6 +71,22 @@ try:
 except Exception:
     fitz = None
 
+# Enumeración nativa de directorios en Windows (ver ``_ntscandir``).  En
+# otros sistemas, o si no se puede cargar, se usa ``os.scandir``.
+try:
+    import _ntscandir  # type: ignore
+except Exception:
+    _ntscandir = None
+
+# Logger del escáner (los handlers se configuran en ``init_logger``) y
+# función de encogimiento del almacén de MuPDF, resueltos una sola vez.
+logger = logging.getLogger("scan_ntfs")
+_store_shrink = getattr(fitz, "TOOLS", None) and fitz.TOOLS.store_shrink
+# Flags de extracción de texto sin imágenes: para saber si una página tiene
+# texto no hace falta decodificar ni conservar las imágenes incrustadas.
+_TEXT_FLAGS: int = (getattr(fitz, "TEXTFLAGS_TEXT", 0)
+                    & ~getattr(fitz, "TEXT_PRESERVE_IMAGES", 0)) if fitz is not None else 0
+
 # ----------------------------------------------------------------------
 # Constantes de configuración
 # ----------------------------------------------------------------------
@@ -82,7 +100,25 @@ DEFAULT_LOG: str = r"C:\ANH\ANH\scan_errores.log"
 # Otros ajustes por defecto
 DEFAULT_PDF_PAGES: int = 5
 DEFAULT_PROGRESS_EVERY: int = 500
-DEFAULT_WORKERS: int = min(8, max(1, (os.cpu_count() or 1) * 2))
+# Tamaño del búfer de E/S del CSV de salida y umbral a partir del cual el
+# búfer de filas se vuelca aunque no se haya llegado a la ventana de progreso.
+CSV_BUFFER_SIZE: int = 1 << 20
+# Máximo de registros de estado acumulados antes de un commit, aunque la
+# ventana de progreso sea mayor (o esté desactivada).
+STATE_BATCH_SIZE: int = 1000
+# Cada cuántos archivos procesados se comprueban, como mínimo, los errores
+# del hilo escritor aunque ``--progress-every`` y ``--gc-every`` sean 0.
+SINK_CHECK_EVERY: int = 1000
+# Máximo de registros de estado que se cargan en memoria al reanudar; por
+# encima se consulta SQLite archivo a archivo (``already_processed``).  Con
+# rutas ``\\?\UNC\...`` reales cada registro ocupa unos 310 bytes en el
+# diccionario: 2 millones son unos 600 MB.
+DEFAULT_STATE_INDEX_MAX: int = 2_000_000
+# Procesos del pool de PDFs: el análisis es CPU, así que uno por núcleo
+DEFAULT_WORKERS: int = min(8, max(1, os.cpu_count() or 1))
+# Hilos dedicados a leer directorios en paralelo: casi todo su tiempo es
+# espera de red, así que se dimensionan por encima del número de núcleos
+DEFAULT_DIR_WORKERS: int = min(32, (os.cpu_count() or 4) * 4)
 
 # Ajustes de gestión de memoria.  ``DEFAULT_GC_EVERY`` controla cada cuántos
 # archivos procesados se fuerza una recolección de basura y se encoge el
@@ -91,6 +127,28 @@ DEFAULT_WORKERS: int = min(8, max(1, (os.cpu_count() or 1) * 2))
 # altos comprimen más memoria pero consumen más CPU).
 DEFAULT_GC_EVERY: int = 5000
 DEFAULT_STORE_SHRINK: int = 50
+# Tope (en MB) del almacén de recursos de MuPDF.  Al superarlo tras un
+# documento se encoge sólo lo necesario para volver bajo el tope.  Sólo
+# funciona con los bindings clásicos de PyMuPDF: desde 1.24
+# ``TOOLS.store_size()`` devuelve ``None`` y el tope se ignora (ver
+# ``mupdf_store_size``).
+DEFAULT_STORE_MAXSIZE_MB: int = 64
+# Documentos que clasifica cada proceso del pool de PDFs antes de ser
+# reemplazado por uno nuevo (libera la memoria retenida por MuPDF).
+PDF_TASKS_PER_CHILD: int = 100
+# Cada cuántos documentos vacía cada proceso del pool el almacén de MuPDF
+# (``store_shrink(100)``) y fuerza ``gc.collect()`` por su cuenta.
+PDF_WORKER_SHRINK_EVERY: int = 50
+# Máximo de procesos que admite ``ProcessPoolExecutor`` en Windows
+# (limitación de ``WaitForMultipleObjects``).
+MAX_WINDOWS_PDF_WORKERS: int = 61
+# Bytes iniciales en los que se busca la cabecera ``%PDF`` antes de abrir
+# el documento con PyMuPDF (los lectores la aceptan dentro del primer KB).
+PDF_HEADER_WINDOW: int = 1024
+# PDFs en vuelo por proceso antes de frenar el recorrido (contrapresión):
+# al alcanzar ``workers * PDF_PENDING_PER_WORKER`` se espera a que termine
+# alguno antes de enviar más.
+PDF_PENDING_PER_WORKER: int = 4
 
 # Lista de subcarpetas de primer nivel por defecto (orden obligatorio).
 TOPDIRS_DEFAULT: List[str] = [
@@ -129,6 +187,9 @@ _RESERVED_NAMES: set = {
 
 # Caracteres ilegales en nombres de archivo
 _ILLEGAL_CHARS: str = '<>:"/\\|?*'
+# Tabla de ``str.translate`` que sustituye los caracteres ilegales y los
+# espacios por guiones bajos en una sola pasada
+_ILLEGAL_TRANS: Dict[int, str] = str.maketrans({c: "_" for c in _ILLEGAL_CHARS + " "})
 
 # ----------------------------------------------------------------------
 # Utilidades de manejo de rutas y normalización
@@ -221,13 +282,29 @@ def init_sqlite_state(db_path: str, reset: bool = False) -> sqlite3.Connection:
     Crea o abre la base de datos de estado.  Si ``reset`` es True, se
     elimina la base existente antes de crearla.  Esta BD almacena los
     archivos procesados y el progreso por carpeta para permitir reanudación.
+    La conexión se abre en modo WAL con ``synchronous=NORMAL`` para que los
+    commits periódicos sean baratos.
     """
-    if reset and os.path.exists(db_path):
-        os.remove(db_path)
+    if reset:
+        # Con WAL también hay que borrar los archivos -wal/-shm asociados
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
     dirpath = os.path.dirname(db_path)
     if dirpath:
         os.makedirs(dirpath, exist_ok=True)
-    conn = sqlite3.connect(db_path)
+    # El hilo escritor (``csv_sink``) hace los commits mientras está vivo;
+    # el hilo principal sólo usa la conexión antes de arrancarlo o tras unirlo.
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    # WAL + synchronous=NORMAL: los commits sólo anexan al journal y no
+    # fuerzan un fsync de la BD completa; los lectores no bloquean al escritor.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")        # 64 MB de caché de páginas
+    conn.execute("PRAGMA mmap_size=268435456")      # 256 MB mapeados en memoria
+    conn.execute("PRAGMA wal_autocheckpoint=10000")
+    conn.execute("PRAGMA busy_timeout=5000")
     # Tabla de archivos procesados: path_abs clave primaria
     conn.execute(
         """
@@ -254,7 +331,11 @@ def init_sqlite_state(db_path: str, reset: bool = False) -> sqlite3.Connection:
 
 
 def mark_topdir_finished(conn: sqlite3.Connection, topdir: str) -> None:
-    """Marca una subcarpeta como finalizada en la tabla scan_progress."""
+    """
+    Marca una subcarpeta como finalizada en la tabla scan_progress.  El
+    commit confirma también el último lote de estado que haya dejado
+    abierto el hilo escritor (ver ``csv_sink``).
+    """
     conn.execute(
         "INSERT INTO scan_progress(topdir,finished,finished_ts) VALUES(?,?,?) "
         "ON CONFLICT(topdir) DO UPDATE SET finished=excluded.finished, finished_ts=excluded.finished_ts",
@@ -291,17 +372,113 @@ def already_processed(conn: sqlite3.Connection, path_abs: str,
     return bool(row and row[0] == size_bytes and row[1] == mtime_ns)
 
 
-def upsert_state(conn: sqlite3.Connection, path_abs: str,
-                 size_bytes: int, mtime_ns: int) -> None:
+def load_state(conn: sqlite3.Connection) -> Dict[str, Tuple[int, int]]:
     """
-    Inserta o actualiza el registro de un archivo procesado en la base de
-    datos.  Utiliza la ruta absoluta como clave primaria.
+    Carga en memoria el índice de archivos procesados como un diccionario
+    ``path_abs -> (size_bytes, mtime_ns)``.  Con una única consulta se evita
+    un ``SELECT`` por cada archivo recorrido.
     """
-    conn.execute(
+    cur = conn.execute("SELECT path_abs, size_bytes, mtime_ns FROM processed_files")
+    return {p: (sz, mt) for p, sz, mt in cur}
+
+
+def already_processed_mem(index: Dict[str, Tuple[int, int]], path_abs: str,
+                          size_bytes: int, mtime_ns: int) -> bool:
+    """Equivalente a ``already_processed`` sobre el índice cargado con ``load_state``."""
+    v = index.get(path_abs)
+    return v is not None and v == (size_bytes, mtime_ns)
+
+
+def flush_state(conn: sqlite3.Connection,
+                rows: List[Tuple[str, int, int, int]],
+                index: Optional[Dict[str, Tuple[int, int]]] = None,
+                commit: bool = True) -> None:
+    """
+    Inserta o actualiza en una única transacción los registros de archivos
+    procesados acumulados en ``rows`` (tuplas ``(path_abs, size_bytes,
+    mtime_ns, written_ts)``) y vacía la lista.  Utiliza la ruta absoluta
+    como clave primaria.  Si se indica ``index`` (ver ``load_state``), se
+    actualiza también en memoria.  Con ``commit=False`` la transacción
+    queda abierta para que el llamador la cierre junto con otras escrituras.
+    """
+    if not rows:
+        return
+    if index is not None:
+        for path_abs, size_bytes, mtime_ns, _ in rows:
+            index[path_abs] = (size_bytes, mtime_ns)
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    conn.executemany(
         "INSERT OR REPLACE INTO processed_files(path_abs,size_bytes,mtime_ns,written_ts)"
         " VALUES (?,?,?,?)",
-        (path_abs, size_bytes, mtime_ns, int(time.time() * 1000)),
+        rows,
     )
+    if commit:
+        conn.commit()
+    rows.clear()
+
+
+# Tope en bytes del almacén de MuPDF (0 = sin tope), fijado por ``configure_mupdf``
+_store_limit: int = 0
+
+
+def mupdf_store_size() -> Optional[int]:
+    """
+    Tamaño actual en bytes del almacén de MuPDF, o ``None`` si PyMuPDF no lo
+    informa (desde 1.24 ``TOOLS.store_size()`` es un stub que devuelve
+    ``None``).
+    """
+    if fitz is None or not hasattr(fitz, "TOOLS"):
+        return None
+    try:
+        used = fitz.TOOLS.store_size
+        if callable(used):
+            used = used()
+    except Exception:
+        return None
+    return used if isinstance(used, int) else None
+
+
+def configure_mupdf(store_maxsize: int) -> bool:
+    """
+    Configura PyMuPDF en el proceso actual: silencia los mensajes de MuPDF
+    por stderr (los errores siguen llegando como excepciones) y fija
+    ``store_maxsize`` bytes como tope del almacén.  PyMuPDF no permite
+    cambiar el máximo del contexto ya creado (``TOOLS.store_maxsize`` es de
+    sólo lectura), así que el tope se aplica con ``enforce_store_cap`` tras
+    cada documento.  Devuelve False si se pidió un tope pero esta versión
+    de PyMuPDF no informa el tamaño del almacén (el tope no se aplica).
+    """
+    global _store_limit
+    if fitz is None or not hasattr(fitz, "TOOLS"):
+        return True
+    try:
+        fitz.TOOLS.mupdf_display_errors(False)
+    except Exception:
+        pass
+    if store_maxsize > 0 and mupdf_store_size() is None:
+        _store_limit = 0
+        return False
+    _store_limit = max(0, store_maxsize)
+    return True
+
+
+def enforce_store_cap() -> None:
+    """
+    Si el almacén de MuPDF supera el tope configurado, lo encoge en el
+    porcentaje justo para volver a quedar por debajo.  Consultar el tamaño
+    es inmediato, por lo que normalmente no se recorre la caché.  Con las
+    versiones de PyMuPDF que no informan el tamaño del almacén no hay tope
+    (``configure_mupdf`` lo deja a 0).
+    """
+    if not _store_limit or not _store_shrink:
+        return
+    used = mupdf_store_size()
+    if used is not None and used > _store_limit:
+        try:
+            _store_shrink(max(1, 100 - (100 * _store_limit) // used))
+        except Exception:
+            pass
 
 
 def classify_pdf(path_abs: str, max_pages: int = 5) -> str:
@@ -312,73 +489,177 @@ def classify_pdf(path_abs: str, max_pages: int = 5) -> str:
       - ``"0"`` si se detecta texto en las primeras ``max_pages`` páginas,
       - ``""`` si no se pudo determinar (errores, PDF vacío, no PDF, etc.).
 
-    Se captura cualquier excepción de PyMuPDF o de I/O, se registra en
-    el logger y se devuelve "".  Además, tras analizar un documento,
-    se asegura el cierre de ``doc`` y se realiza ``store_shrink`` para
-    liberar cachés internos de MuPDF.
+    Antes de abrirlo con PyMuPDF se leen los primeros ``PDF_HEADER_WINDOW``
+    bytes: si no contienen ``%PDF`` (archivo vacío, truncado o que no es un
+    PDF) se registra y se devuelve "" sin pasar por el analizador.
+
+    El documento se abre una sola vez y, si la apertura falla, la excepción
+    se propaga: el llamador aplaza el archivo y lo reintenta al final del
+    topdir con ``retry_classify_pdf`` (así ningún proceso queda dormido
+    esperando a que pase un bloqueo transitorio del recurso compartido).
+    Cualquier otra excepción de PyMuPDF o de I/O se registra en el logger y
+    se devuelve "".  Tras analizar un documento se asegura el cierre de
+    ``doc`` y se mantiene el almacén de MuPDF bajo su tope
+    (``enforce_store_cap``); no se hace un ``store_shrink`` por documento.
     """
     if fitz is None:
         return ""
-    logger = logging.getLogger("scan_ntfs")
-    doc = None
+    # Prefiltro barato por cabecera; un error de apertura se propaga igual
+    # que el de ``fitz.open``
+    with open(path_abs, "rb") as fh:
+        head = fh.read(PDF_HEADER_WINDOW)
+    if b"%PDF" not in head:
+        logger.error(f"No es un PDF (sin cabecera %PDF): {path_abs}")
+        return ""
+    # ``filetype="pdf"`` evita que MuPDF tenga que deducir el formato
+    doc = fitz.open(path_abs, filetype="pdf")
     try:
-        try:
-            doc = fitz.open(path_abs)
-        except Exception:
-            # Reintento por posibles bloqueos temporales o errores transitorios
-            time.sleep(random.uniform(0.2, 0.5))
-            doc = fitz.open(path_abs)
         if doc.is_encrypted:
             logger.error(f"PDF encriptado: {path_abs}")
             return ""
-        # Limitar a 'max_pages' o al total de páginas
+        # Limitar a 'max_pages' o al total de páginas; ``doc.pages`` recorre
+        # el árbol de páginas una sola vez en lugar de un ``load_page`` por índice
         pages = min(max_pages, max(0, doc.page_count))
-        for i in range(pages):
-            try:
-                page = doc.load_page(i)
-                if page.get_text().strip():
+        i = 0
+        try:
+            for page in doc.pages(0, pages):
+                blocks = page.get_text("blocks", flags=_TEXT_FLAGS)
+                if any(isinstance(b[4], str) and b[4].strip() for b in blocks):
                     return "0"
-            except Exception as e:
-                logger.error(f"Error leyendo página {i+1} de {path_abs}: {e!r}")
-                return ""
+                i += 1
+        except Exception as e:
+            logger.error(f"Error leyendo página {i+1} de {path_abs}: {e!r}")
+            return ""
         return "1"
     except Exception as e:
         logger.error(f"Error procesando PDF {path_abs}: {e!r}")
         return ""
     finally:
         # Asegurar cierre del documento
-        if doc is not None:
-            try:
-                doc.close()
-            except Exception:
-                pass
-        # Intentar liberar cachés de MuPDF (store_shrink)
-        if fitz is not None and hasattr(fitz, "TOOLS"):
+        try:
+            doc.close()
+        except Exception:
+            pass
+        enforce_store_cap()
+
+
+def retry_classify_pdf(path_abs: str, max_pages: int = 5) -> str:
+    """
+    Segundo y último intento de ``classify_pdf`` para un PDF cuya apertura
+    falló en la primera pasada: si vuelve a fallar se registra el error y
+    el PDF queda indeterminado (``""``).
+    """
+    try:
+        return classify_pdf(path_abs, max_pages)
+    except Exception as e:
+        logger.error(f"Error procesando PDF {path_abs}: {e!r}")
+        return ""
+
+
+class _ListHandler(logging.Handler):
+    """Handler que acumula en memoria los mensajes emitidos (procesos del pool de PDFs)."""
+
+    def __init__(self) -> None:
+        super().__init__(logging.INFO)
+        self.messages: List[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+
+
+# Handler del proceso hijo del pool de PDFs (ver ``_init_pdf_worker``) y
+# documentos clasificados por ese proceso
+_worker_log: Optional[_ListHandler] = None
+_worker_jobs: int = 0
+
+
+def _init_pdf_worker(store_maxsize: int) -> None:
+    """
+    Inicializador de cada proceso del pool de PDFs.  Aplica el tope del
+    almacén de MuPDF y sustituye los handlers heredados del logger por un
+    ``_ListHandler``: los mensajes de ``classify_pdf`` se devuelven al
+    proceso principal, que es el único que escribe (y rota) el log.
+    """
+    global _worker_log
+    configure_mupdf(store_maxsize)
+    _worker_log = _ListHandler()
+    logger.handlers[:] = [_worker_log]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+
+def _classify_pdf_job(path_abs: str, max_pages: int, final: bool = False) -> Tuple[Optional[str], List[str]]:
+    """
+    Tarea ejecutada en el pool de procesos: clasifica el PDF y devuelve
+    ``(flag, mensajes_de_error)`` para que el proceso principal los registre.
+    ``flag`` es ``None`` si el PDF no se pudo abrir; el proceso principal lo
+    aplaza para un segundo intento (ver ``classify_pdf``).  En ese segundo
+    intento (``final``) se usa ``retry_classify_pdf``, que nunca devuelve
+    ``None``.  Cada
+    ``PDF_WORKER_SHRINK_EVERY`` documentos el proceso vacía el almacén de
+    MuPDF y recolecta basura, sin esperar al reciclado del proceso.
+    """
+    global _worker_jobs
+    if _worker_log is not None:
+        _worker_log.messages.clear()
+    if final:
+        flag: Optional[str] = retry_classify_pdf(path_abs, max_pages)
+    else:
+        try:
+            flag = classify_pdf(path_abs, max_pages)
+        except Exception:
+            flag = None
+    _worker_jobs += 1
+    if _worker_jobs % PDF_WORKER_SHRINK_EVERY == 0:
+        if _store_shrink:
             try:
-                fitz.TOOLS.store_shrink(DEFAULT_STORE_SHRINK)
+                _store_shrink(100)
             except Exception:
                 pass
+        gc.collect()
+    return flag, list(_worker_log.messages) if _worker_log is not None else []
 
 
-def bytes_to_kb_mb(size_bytes: int) -> Tuple[float, float]:
-    """Convierte bytes a kilobytes y megabytes con precisión decimal."""
-    return size_bytes / 1024.0, size_bytes / (1024.0 * 1024.0)
+def make_pdf_executor(workers: int, store_maxsize: int) -> Tuple[concurrent.futures.ProcessPoolExecutor, bool]:
+    """
+    Crea el pool de procesos para ``classify_pdf``.  Cada proceso hijo se
+    recicla tras ``PDF_TASKS_PER_CHILD`` documentos, lo que acota la memoria
+    que MuPDF retiene entre documentos.  Devuelve ``(executor, auto)``;
+    ``auto`` es False en Python < 3.11 (sin ``max_tasks_per_child``), en cuyo
+    caso el llamador debe reciclar el pool completo periódicamente.  En
+    Windows el número de procesos se limita a ``MAX_WINDOWS_PDF_WORKERS``.
+    """
+    if os.name == "nt":
+        workers = min(workers, MAX_WINDOWS_PDF_WORKERS)
+    try:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_pdf_worker,
+            initargs=(store_maxsize,), max_tasks_per_child=PDF_TASKS_PER_CHILD)
+        return executor, True
+    except TypeError:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_pdf_worker,
+            initargs=(store_maxsize,))
+        return executor, False
 
 
 def list_first_level_dirs(root_path: str) -> List[str]:
-    """Devuelve las subcarpetas inmediatas de ``root_path`` (primer nivel)."""
+    """
+    Devuelve las subcarpetas inmediatas de ``root_path`` (primer nivel).
+    Usa los tipos que ya trae ``os.scandir`` (sin un ``stat`` por entrada)
+    y, como el recorrido, no sigue enlaces simbólicos.
+    """
+    dirs: List[str] = []
     try:
-        entries = os.listdir(root_path)
-    except Exception:
+        with os.scandir(root_path) as it:
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        dirs.append(e.name)
+                except OSError:
+                    continue
+    except OSError:
         return []
-    dirs: List[str] = []
-    for e in entries:
-        p = os.path.join(root_path, e)
-        try:
-            if os.path.isdir(p):
-                dirs.append(e)
-        except Exception:
-            continue
     return dirs
 
 
@@ -405,9 +686,7 @@ def sanitize_for_filename(name: str) -> str:
     Windows: reemplaza caracteres ilegales, espacios por guiones bajos y
     evita nombres reservados añadiendo un sufijo.
     """
-    s = name.strip().replace(" ", "_")
-    for ch in _ILLEGAL_CHARS:
-        s = s.replace(ch, "_")
+    s = name.strip().translate(_ILLEGAL_TRANS)
     base = os.path.splitext(s)[0].upper()
     if base in _RESERVED_NAMES:
         s = s + "_dir"
@@ -437,29 +716,69 @@ def compute_out_csv(base_out: str, topdir: str) -> str:
 # ----------------------------------------------------------------------
 # Escritura segura de CSV
 # ----------------------------------------------------------------------
-def safe_writerow(csvw: csv.writer, row: List[str], csv_fp, log: logging.Logger, retries: int = 6) -> None:
+def _csv_escape(field: str) -> str:
+    """
+    Escapa un campo con la misma política que ``csv.writer`` por defecto
+    (``QUOTE_MINIMAL``): se entrecomilla sólo si contiene coma, comillas o
+    saltos de línea, duplicando las comillas internas.
+    """
+    if '"' in field:
+        return '"' + field.replace('"', '""') + '"'
+    if "," in field or "\n" in field or "\r" in field:
+        return '"' + field + '"'
+    return field
+
+
+class BufferedCsvWriter:
+    """
+    Sustituto de ``csv.writer`` para el archivo de salida abierto en modo
+    binario.  ``writerow`` sólo codifica la fila a UTF-8 y la anexa a un
+    ``bytearray``; el contenido llega al archivo en un único ``write`` al
+    llamar a ``flush`` (en cada ventana de progreso), en lugar de una
+    escritura por fila.  El formato es idéntico al de ``csv.writer``
+    (comillas mínimas y fin de línea ``\r\n``).
+
+    Casi ninguna fila necesita comillas: se une la fila tal cual y sólo si
+    el resultado contiene comillas, saltos de línea o más comas que
+    separadores se recurre al escapado campo a campo (``_csv_escape``).
     """
-    Escribe una fila en el CSV con reintentos ante ``PermissionError`` u
-    ``OSError`` relacionados con accesos concurrentes al archivo.  Si la
-    escritura falla, realiza un flush del archivo y espera un tiempo
-    incremental antes de reintentar.  Levanta ``PermissionError`` si no
+
+    def __init__(self, fp) -> None:
+        self.fp = fp
+        self.buf = bytearray()
+
+    def writerow(self, row: List[str]) -> None:
+        line = ",".join(row)
+        if ('"' in line or "\n" in line or "\r" in line
+                or line.count(",") != len(row) - 1):
+            line = ",".join([_csv_escape(c) for c in row])
+        self.buf += line.encode("utf-8")
+        self.buf += b"\r\n"
+
+    def flush(self) -> None:
+        if self.buf:
+            self.fp.write(self.buf)
+            self.buf.clear()
+        self.fp.flush()
+
+
+def safe_flush(csvw: BufferedCsvWriter, log: logging.Logger, retries: int = 6) -> None:
+    """
+    Vuelca al archivo el búfer de ``csvw`` con reintentos ante
+    ``PermissionError`` u ``OSError`` relacionados con accesos concurrentes
+    al archivo (típico cuando el CSV está abierto en otra aplicación).  Si
+    el volcado falla, espera un tiempo incremental antes de reintentar;
+    como ``BufferedCsvWriter.flush`` sólo vacía el búfer tras escribirlo,
+    no se pierden ni se duplican filas.  Levanta ``PermissionError`` si no
     se consigue escribir tras varios intentos.
 
-    :param csvw: escritor CSV (csv.writer)
-    :param row: fila a escribir (lista de strings)
-    :param csv_fp: archivo abierto (usado para flush)
+    :param csvw: escritor CSV (BufferedCsvWriter)
     :param log: logger para registrar errores
     :param retries: número máximo de reintentos antes de fallar
     """
     for i in range(retries):
         try:
-            csvw.writerow(row)
-            if i > 0:
-                # Si hubo reintentos, hacer flush explícito
-                try:
-                    csv_fp.flush()
-                except Exception:
-                    pass
+            csvw.flush()
             return
         except PermissionError as e:
             # Error típico de archivo bloqueado
@@ -468,7 +787,7 @@ def safe_writerow(csvw: csv.writer, row: List[str], csv_fp, log: logging.Logger,
                 f"PermissionError escribiendo CSV (reintento {i+1}/{retries}, espera {wait:.1f}s): {e!r}"
             )
             try:
-                csv_fp.flush()
+                csvw.fp.flush()
             except Exception:
                 pass
             time.sleep(wait)
@@ -481,7 +800,7 @@ def safe_writerow(csvw: csv.writer, row: List[str], csv_fp, log: logging.Logger,
                     f"OSError escribiendo CSV (reintento {i+1}/{retries}, espera {wait:.1f}s): {e!r}"
                 )
                 try:
-                    csv_fp.flush()
+                    csvw.fp.flush()
                 except Exception:
                     pass
                 time.sleep(wait)
@@ -489,38 +808,290 @@ def safe_writerow(csvw: csv.writer, row: List[str], csv_fp, log: logging.Logger,
                 # Otros errores se propagan
                 raise
     # Tras agotar reintentos, relanzar
-    raise PermissionError("No se pudo escribir la fila CSV tras múltiples reintentos.")
-
-
-def walk_files_under(root_path: str, exclude_dirs: Optional[List[str]] = None) -> Iterable[Tuple[str, str]]:
-    """
-    Generador que recorre recursivamente los archivos bajo ``root_path``.
-    Devuelve tuplas (ruta_absoluta_normalizada, ruta_relativa).  Usa
-    ``exclude_dirs`` para omitir subdirectorios por nombre literal.
-    Si la ruta no se puede normalizar (componentes inválidos), devuelve
-    ``(None, None)`` como marcador de error.
-    """
-    for cur_root, dirs, files in os.walk(root_path, topdown=True):
-        # Filtrar directorios excluidos
-        if exclude_dirs:
-            dirs[:] = [d for d in dirs if d not in exclude_dirs]
-        # Omitir enlaces simbólicos
-        dirs[:] = [d for d in dirs if not os.path.islink(os.path.join(cur_root, d))]
-        for fname in files:
-            abs_p = os.path.join(cur_root, fname)
-            p_abs = normalize_path(abs_p)
-            if not p_abs:
-                # Ruta inválida: se puede llevar conteo de errores externamente
-                yield None, None
+    raise PermissionError("No se pudo volcar el CSV tras múltiples reintentos.")
+
+
+def csv_sink(rowq: queue.SimpleQueue, csvw: BufferedCsvWriter, conn: sqlite3.Connection,
+             index: Optional[Dict[str, Tuple[int, int]]], flush_every: int,
+             log: logging.Logger, errors: List[BaseException]) -> None:
+    """
+    Cuerpo del hilo escritor.  Consume de ``rowq`` tuplas ``(fila, estado)``
+    hasta recibir ``None``: escribe cada fila en ``csvw`` y acumula su
+    registro de estado ``(path_abs, size_bytes, mtime_ns, written_ts)``.
+    Cada ``flush_every`` filas (o al acumular ``STATE_BATCH_SIZE``
+    registros), y al terminar, vuelca el CSV y después hace commit del
+    estado en lote (ver ``flush_state``), de modo que el hilo principal no
+    se bloquea en la E/S del CSV ni en SQLite.  El último lote se inserta
+    sin commit: lo confirma el hilo principal tras unir el hilo, en la
+    misma transacción que marca la carpeta como terminada.
+
+    Si una escritura falla, la excepción se deja en ``errors``, se descarta
+    el estado pendiente (esas filas se reprocesarán al reanudar) y se sigue
+    vaciando la cola hasta el centinela para no retener al productor.
+    """
+    pending: List[Tuple[str, int, int, int]] = []
+    n = 0
+    failed = False
+    while True:
+        item = rowq.get()
+        if item is None:
+            break
+        if failed:
+            continue
+        row, state = item
+        try:
+            # Sólo se anexa al búfer; los reintentos están en ``safe_flush``
+            csvw.writerow(row)
+            pending.append(state)
+            n += 1
+            if (flush_every and n % flush_every == 0) or len(pending) >= STATE_BATCH_SIZE:
+                safe_flush(csvw, log)
+                flush_state(conn, pending, index)
+            elif len(csvw.buf) >= CSV_BUFFER_SIZE:
+                safe_flush(csvw, log)
+        except Exception as e:
+            errors.append(e)
+            failed = True
+            pending.clear()
+    if not failed:
+        try:
+            safe_flush(csvw, log)
+            flush_state(conn, pending, index, commit=False)
+        except Exception as e:
+            errors.append(e)
+
+
+# Entrada de archivo de ``scandir_list``: (ruta, nombre, tamaño, mtime_ns)
+FileEntry = Tuple[str, str, Optional[int], Optional[int]]
+
+# Errores de Windows con los que un directorio se da por ilegible (como con
+# ``os.scandir``): archivo o ruta inexistente y acceso denegado
+_UNREADABLE_WINERRORS: FrozenSet[int] = frozenset((2, 3, 5))
+# False si el servidor rechazó la consulta de ``_ntscandir``; desde entonces
+# todos los directorios se leen con ``os.scandir``
+_nt_scandir_ok: bool = True
+
+
+def _stat_or_none(path: str) -> Tuple[Optional[int], Optional[int]]:
+    """Devuelve ``(tamaño, mtime_ns)`` de ``os.stat`` o ``(None, None)`` si falla."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    return st.st_size, st.st_mtime_ns
+
+
+def stat_with_retry(path_abs: str, log: logging.Logger, label: str = ""
+                    ) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Obtiene ``(tamaño, mtime_ns)`` con ``os.stat`` para un archivo cuya
+    enumeración no los aportó.  Sólo si ese ``stat`` falla se registra el
+    error, se espera un tiempo aleatorio corto y se reintenta una vez;
+    devuelve ``(None, None)`` si vuelve a fallar.  ``label`` precede a los
+    mensajes del log (p. ej. ``"[topdir] "``).
+    """
+    try:
+        st = os.stat(path_abs)
+    except OSError as e:
+        log.error(f"{label}Error accediendo a {path_abs}: {e!r}")
+        time.sleep(random.uniform(0.2, 0.5))
+        try:
+            st = os.stat(path_abs)
+        except Exception as e2:
+            log.error(f"{label}Fallo definitivo accediendo a {path_abs}: {e2!r}")
+            return None, None
+    return st.st_size, st.st_mtime_ns
+
+
+def _scandir_list_nt(dir_path: str, exclude_dirs: Optional[FrozenSet[str]] = None
+                     ) -> Tuple[List[FileEntry], List[Tuple[str, str]]]:
+    """
+    Variante de ``scandir_list`` para Windows sobre ``_ntscandir.scandir_nt``:
+    una llamada al sistema por cada bloque de 64 KB de entradas, con tamaño
+    y fecha de modificación incluidos.  Sólo los enlaces a archivos (puntos
+    de reparse) requieren un ``os.stat`` para obtener los datos del destino.
+
+    Un directorio inexistente o con acceso denegado se devuelve vacío.  Si
+    la lectura falla tras algún bloque se conservan las entradas ya leídas;
+    con cualquier otro error (p. ej. un servidor SMB que no admite la clase
+    de información) se registra y el directorio se lee con ``os.scandir``.
+    """
+    global _nt_scandir_ok
+    files: List[FileEntry] = []
+    subdirs: List[Tuple[str, str]] = []
+    try:
+        entries = _ntscandir.scandir_nt(dir_path)
+    except OSError as e:
+        if getattr(e, "winerror", None) in _UNREADABLE_WINERRORS:
+            return files, subdirs
+        entries = getattr(e, "entries", None)
+        if entries:
+            logger.error(f"Lectura de directorio interrumpida {dir_path}: {e!r}")
+        else:
+            if getattr(e, "ntstatus", None) in (_ntscandir.STATUS_INVALID_INFO_CLASS,
+                                                _ntscandir.STATUS_NOT_SUPPORTED,
+                                                _ntscandir.STATUS_INVALID_PARAMETER):
+                # El servidor no admite la consulta: no volver a intentarla
+                if _nt_scandir_ok:
+                    logger.error(f"NtQueryDirectoryFileEx no admitido ({e!r}); se usa os.scandir")
+                _nt_scandir_ok = False
+            else:
+                logger.error(f"Error leyendo directorio {dir_path} ({e!r}); se reintenta con os.scandir")
+            return _scandir_list_os(dir_path, exclude_dirs)
+    prefix = dir_path if dir_path.endswith("\\") else dir_path + "\\"
+    for name, attrs, size, mtime_ns, reparse_tag in entries:
+        is_reparse = attrs & _ntscandir.FILE_ATTRIBUTE_REPARSE_POINT
+        if attrs & _ntscandir.FILE_ATTRIBUTE_DIRECTORY:
+            # Omitir directorios excluidos y enlaces simbólicos
+            if (is_reparse and reparse_tag == _ntscandir.IO_REPARSE_TAG_SYMLINK) or \
+                    (exclude_dirs and name in exclude_dirs):
+                continue
+            subdirs.append((prefix + name, name))
+        elif is_reparse:
+            size, mtime_ns = _stat_or_none(prefix + name)
+            files.append((prefix + name, name, size, mtime_ns))
+        else:
+            files.append((prefix + name, name, size, mtime_ns))
+    return files, subdirs
+
+
+def scandir_list(dir_path: str, exclude_dirs: Optional[FrozenSet[str]] = None
+                 ) -> Tuple[List[FileEntry], List[Tuple[str, str]]]:
+    """
+    Lee una sola vez el directorio ``dir_path`` y devuelve
+    ``(archivos, subdirectorios)``.  Cada subdirectorio es ``(ruta, nombre)``
+    y cada archivo ``(ruta, nombre, tamaño, mtime_ns)``, tomados de la propia
+    enumeración (``_ntscandir`` en Windows, ``DirEntry.stat()`` con
+    ``os.scandir`` en el resto) o ``None`` si no se pudieron
+    obtener.  Omite subdirectorios excluidos por nombre literal y enlaces
+    simbólicos.  Igual que ``os.walk``, si el directorio no se puede abrir
+    devuelve listas vacías y si la lectura falla a mitad se detiene ahí y
+    conserva las entradas ya leídas.  Es segura para ejecutarse en hilos.
+    """
+    if _ntscandir is not None and _nt_scandir_ok:
+        return _scandir_list_nt(dir_path, exclude_dirs)
+    return _scandir_list_os(dir_path, exclude_dirs)
+
+
+def _scandir_list_os(dir_path: str, exclude_dirs: Optional[FrozenSet[str]] = None
+                     ) -> Tuple[List[FileEntry], List[Tuple[str, str]]]:
+    """Variante de ``scandir_list`` sobre ``os.scandir`` (ver ``scandir_list``)."""
+    files: List[FileEntry] = []
+    subdirs: List[Tuple[str, str]] = []
+    try:
+        it = os.scandir(dir_path)
+    except OSError:
+        return files, subdirs
+    with it:
+        while True:
+            try:
+                entry = next(it)
+            except StopIteration:
+                break
+            except OSError as e:
+                # Lectura interrumpida (p. ej. recurso de red perdido)
+                logger.error(f"Lectura de directorio interrumpida {dir_path}: {e!r}")
+                break
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                try:
+                    is_symlink = entry.is_symlink()
+                except OSError:
+                    is_symlink = False
+                # Omitir directorios excluidos y enlaces simbólicos
+                if is_symlink or (exclude_dirs and entry.name in exclude_dirs):
+                    continue
+                subdirs.append((entry.path, entry.name))
                 continue
             try:
-                rel_path = os.path.relpath(p_abs, root_path)
-            except Exception:
-                if p_abs.lower().startswith(root_path.lower()):
-                    rel_path = p_abs[len(root_path):].lstrip("\\/")
-                else:
-                    rel_path = p_abs
-            yield p_abs, rel_path
+                st = entry.stat()
+            except OSError:
+                files.append((entry.path, entry.name, None, None))
+            else:
+                files.append((entry.path, entry.name, st.st_size, st.st_mtime_ns))
+    return files, subdirs
+
+
+def walk_files_under(root_path: str, exclude_dirs: Optional[FrozenSet[str]] = None,
+                     dir_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None,
+                     max_inflight: int = 1
+                     ) -> Iterable[Tuple[Optional[str], Optional[str], Optional[str], Optional[int], Optional[int]]]:
+    """
+    Generador que recorre recursivamente los archivos bajo ``root_path``,
+    que debe venir ya normalizada (``normalize_path``).
+    Devuelve tuplas (ruta_absoluta_normalizada, ruta_relativa, nombre,
+    tamaño, mtime_ns); el nombre es el de la entrada del directorio
+    (``DirEntry.name``) y tamaño y fecha son ``None`` si la enumeración no
+    los aportó (ver ``scandir_list``).
+    Usa ``exclude_dirs`` para omitir subdirectorios por nombre literal.
+    Las rutas de ``os.scandir`` son la raíz más los nombres de cada nivel,
+    así que no se vuelven a normalizar: sólo se valida cada nombre (y se
+    arrastra la validez del directorio padre), y la ruta relativa es la
+    absoluta sin el prefijo de la raíz (sin ``os.path.relpath``).  Si algún componente es
+    inválido, devuelve ``(None, None, None, None, None)`` como marcador de error.
+
+    Sin ``dir_executor`` el recorrido es secuencial en profundidad (mismo
+    orden que ``os.walk``).  Con ``dir_executor`` se hace en anchura y se
+    mantienen hasta ``max_inflight`` lecturas de directorio concurrentes,
+    de modo que la latencia de cada enumeración sobre UNC se solapa con
+    las demás y con el procesamiento de los archivos ya devueltos.  En ese
+    caso el orden de salida no es determinista.
+    """
+    # Longitud de la raíz más su separador: todas las rutas devueltas la
+    # llevan como prefijo literal
+    prefix_len = len(root_path) if root_path.endswith(("\\", "/")) else len(root_path) + 1
+
+    def _emit(files: List[FileEntry], bad_dir: bool):
+        for p_abs, name, size, mtime_ns in files:
+            if bad_dir or _has_bad_component([name]):
+                # Ruta inválida: se puede llevar conteo de errores externamente
+                yield None, None, None, None, None
+                continue
+            yield p_abs, p_abs[prefix_len:], name, size, mtime_ns
+
+    def _children(subdirs: List[Tuple[str, str]], bad_dir: bool) -> List[Tuple[str, bool]]:
+        return [(d, bad_dir or _has_bad_component([name])) for d, name in subdirs]
+
+    if dir_executor is None:
+        stack: List[Tuple[str, bool]] = [(root_path, False)]
+        while stack:
+            dir_path, bad_dir = stack.pop()
+            files, subdirs = scandir_list(dir_path, exclude_dirs)
+            yield from _emit(files, bad_dir)
+            # Apilar en orden inverso para visitar los subdirectorios en orden
+            stack.extend(reversed(_children(subdirs, bad_dir)))
+        return
+
+    todo = collections.deque([(root_path, False)])
+    # Lecturas en curso: futuro -> validez del directorio leído
+    inflight: Dict[concurrent.futures.Future, bool] = {}
+
+    def _refill() -> None:
+        while todo and len(inflight) < max_inflight:
+            dir_path, bad_dir = todo.popleft()
+            inflight[dir_executor.submit(scandir_list, dir_path, exclude_dirs)] = bad_dir
+
+    try:
+        while todo or inflight:
+            _refill()
+            done, _ = concurrent.futures.wait(
+                inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+            batch = []
+            for fut in done:
+                bad_dir = inflight.pop(fut)
+                files, subdirs = fut.result()
+                todo.extend(_children(subdirs, bad_dir))
+                batch.append((files, bad_dir))
+            # Lanzar nuevas lecturas antes de entregar los archivos al consumidor
+            _refill()
+            for files, bad_dir in batch:
+                yield from _emit(files, bad_dir)
+    finally:
+        for fut in inflight:
+            fut.cancel()
 
 
 def main() -> None:
@@ -558,8 +1129,14 @@ def main() -> None:
                         help="Ignora el estado y reprocesa todos los archivos.")
     parser.add_argument("--reset-state", action="store_true",
                         help="Elimina la BD de estado al iniciar.")
-    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
-                        help="Número de hilos para clasificación de PDFs (>=1).")
+    parser.add_argument("--state-index-max", type=int, default=DEFAULT_STATE_INDEX_MAX,
+                        help="Máximo de registros de estado cargados en memoria al reanudar; "
+                             "por encima se consulta SQLite por archivo (0 = siempre SQLite).")
+    parser.add_argument("--workers", "--cpu-workers", dest="workers", type=int, default=DEFAULT_WORKERS,
+                        help="Número de procesos para clasificación de PDFs (>=1).")
+    parser.add_argument("--dir-workers", "--io-workers", dest="dir_workers", type=int,
+                        default=DEFAULT_DIR_WORKERS,
+                        help="Hilos para leer directorios en paralelo (1 = recorrido secuencial).")
     # Flags del nuevo comportamiento
     parser.add_argument("--scan-mode", choices=["all", "per-topdir"], default="per-topdir",
                         help="Modo de escaneo: 'all' genera un único CSV, 'per-topdir' uno por subcarpeta.")
@@ -572,6 +1149,9 @@ def main() -> None:
                         help="Archivos entre llamadas a gc.collect() y store_shrink().")
     parser.add_argument("--store-shrink", type=int, default=DEFAULT_STORE_SHRINK,
                         help="Número de veces que se invoca fitz.TOOLS.store_shrink() en cada limpieza de memoria.")
+    parser.add_argument("--store-maxsize", type=int, default=DEFAULT_STORE_MAXSIZE_MB,
+                        help="Tope en MB del almacén de MuPDF (0 = sin tope); sólo con los "
+                             "bindings clásicos de PyMuPDF (< 1.24), en otro caso se ignora.")
 
     args = parser.parse_args()
 
@@ -582,6 +1162,12 @@ def main() -> None:
     # Inicializar logger
     log = init_logger(args.log)
 
+    # Tope del almacén de MuPDF (en este proceso y en los del pool de PDFs)
+    store_maxsize = args.store_maxsize * 1024 * 1024
+    if not configure_mupdf(store_maxsize):
+        log.warning("--store-maxsize ignorado: esta versión de PyMuPDF no informa el tamaño "
+                    "del almacén; la memoria se acota con el reciclado de procesos y store_shrink")
+
     # Normalizar ruta raíz
     root_path = normalize_path(args.root)
     if not root_path:
@@ -596,11 +1182,35 @@ def main() -> None:
 
     # Inicializar SQLite
     conn = init_sqlite_state(args.state, reset=args.reset_state)
+    # Índice en memoria de archivos ya procesados (innecesario con --fresh).
+    # Con un estado demasiado grande se consulta SQLite por cada archivo a
+    # través de una segunda conexión de sólo lectura (WAL: no bloquea al
+    # hilo escritor, que es el único que usa ``conn`` mientras está vivo).
+    processed_index: Optional[Dict[str, Tuple[int, int]]] = None
+    lookup_conn: Optional[sqlite3.Connection] = None
+    is_processed = None
+    if not args.fresh:
+        n_state = conn.execute("SELECT COUNT(*) FROM processed_files").fetchone()[0]
+        if 0 < args.state_index_max and n_state <= args.state_index_max:
+            processed_index = load_state(conn)
+            is_processed = functools.partial(already_processed_mem, processed_index)
+        else:
+            lookup_conn = sqlite3.connect(args.state)
+            lookup_conn.execute("PRAGMA query_only=ON")
+            is_processed = functools.partial(already_processed, lookup_conn)
 
     # Parsear listas de extensiones y directorios excluidos
-    include_exts = [e.strip().lower().lstrip(".") for e in args.include_ext.split(",")] if args.include_ext else None
-    exclude_exts = [e.strip().lower().lstrip(".") for e in args.exclude_ext.split(",")] if args.exclude_ext else None
-    exclude_dirs = [d.strip() for d in args.exclude_dirs.split(",")] if args.exclude_dirs else None
+    # (conjuntos: la pertenencia se comprueba por archivo / directorio)
+    include_exts = frozenset(e.strip().lower().lstrip(".") for e in args.include_ext.split(",")) if args.include_ext else None
+    exclude_exts = frozenset(e.strip().lower().lstrip(".") for e in args.exclude_ext.split(",")) if args.exclude_ext else None
+    exclude_dirs = frozenset(d.strip() for d in args.exclude_dirs.split(",")) if args.exclude_dirs else None
+    # Opciones consultadas por cada archivo, resueltas una sola vez
+    limit = args.limit or 0
+    pdf_pages = args.pdf_pages
+    # Archivos admitidos para procesar (cuentan para ``--limit`` al enviarse,
+    # no al terminar, para que los PDFs en curso no hagan rebasar el límite)
+    admitted = 0
+    limit_hit = False
 
     # Permitir borrar checkpoints de ciertas carpetas
     if args.rescan_finished:
@@ -616,46 +1226,235 @@ def main() -> None:
     pdf_x: int = 0
     start_time = time.time()
 
-    # Hilos y cola de futuros
-    use_threads = (args.workers or 1) > 1
-    executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
-    pending: Dict[concurrent.futures.Future, Tuple] = {}
-
-    # Función local para impresión y commits periódicos + GC
-    def periodic_actions(csv_fp: Optional[csv.writer], local_processed: int) -> None:
+    # Pool de procesos para PDFs y cola de futuros
+    use_pool = (args.workers or 1) > 1
+    executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+    executor_auto_recycle = True
+    pdf_submitted = 0
+    # Pool dedicado a la enumeración de directorios
+    dir_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+    dir_inflight = max(1, args.dir_workers or 1) * 2
+    # Cola de finalización del pool de PDFs: cada futuro se encola con su
+    # registro al terminar (callback) y el hilo principal los recoge.
+    # ``in_flight`` cuenta los enviados aún no recogidos; el semáforo limita
+    # los que están en el pool (contrapresión sobre el recorrido).
+    result_q: queue.SimpleQueue = queue.SimpleQueue()
+    in_flight = 0
+    pdf_slots = threading.Semaphore((args.workers or 1) * PDF_PENDING_PER_WORKER)
+    # PDFs cuya apertura falló, pendientes de un segundo intento al final
+    # del recorrido o del topdir (mismos registros que ``result_q``)
+    retry_queue: List[Tuple] = []
+    # PDFs cuyo futuro falló porque un proceso hijo murió (``BrokenProcessPool``);
+    # se reenvían al pool de uno en uno al final del recorrido o del topdir
+    broken_queue: List[Tuple] = []
+    # Hilo escritor del CSV abierto actualmente y su cola de filas
+    rowq: Optional[queue.SimpleQueue] = None
+    sink: Optional[threading.Thread] = None
+    sink_errors: List[BaseException] = []
+
+    def start_sink(csvw: BufferedCsvWriter) -> None:
+        """Arranca el hilo escritor (``csv_sink``) para el CSV de ``csvw``."""
+        nonlocal rowq, sink
+        rowq = queue.SimpleQueue()
+        sink = threading.Thread(
+            target=csv_sink, name="csv-sink",
+            args=(rowq, csvw, conn, processed_index, args.progress_every, log, sink_errors))
+        sink.start()
+
+    def stop_sink() -> None:
+        """
+        Envía el centinela al hilo escritor y espera a que vuelque el CSV y
+        el estado pendientes; relanza el primer error que haya registrado.
+        El último lote de estado queda sin confirmar (ver ``csv_sink``): el
+        llamador hace el commit, o ``mark_topdir_finished`` en modo per-topdir.
         """
-        Realiza acciones periódicas: imprime progreso y hace commit/flush cada
-        ``args.progress_every`` archivos, y ejecuta recolección de basura +
-        ``store_shrink`` cada ``args.gc_every`` archivos.
+        nonlocal rowq, sink
+        if sink is not None:
+            rowq.put(None)
+            sink.join()
+            rowq = sink = None
+        if sink_errors:
+            raise sink_errors[0]
+
+    def emit_row(row: List[str], path_abs: str, size_bytes: int, mtime_ns: int) -> None:
+        """Encola una fila del CSV junto con su registro de estado para el hilo escritor."""
+        rowq.put((row, (path_abs, size_bytes, mtime_ns, int(time.time() * 1000))))
+
+    # Intervalos de las acciones periódicas (en archivos procesados)
+    periodic_steps = [k for k in (args.progress_every, args.gc_every, SINK_CHECK_EVERY) if k > 0]
+
+    def next_periodic_at(n: int) -> int:
+        """Siguiente valor de ``processed`` en el que ``periodic_actions`` tiene algo que hacer."""
+        return min((n // k + 1) * k for k in periodic_steps)
+
+    # Los puntos de llamada sólo invocan ``periodic_actions`` cuando
+    # ``processed`` alcanza este umbral (una comparación por archivo)
+    next_periodic = next_periodic_at(0)
+
+    # Función local para impresión periódica + GC
+    def periodic_actions(local_processed: int) -> None:
         """
-        nonlocal processed, skipped, errors_count
+        Realiza acciones periódicas: imprime progreso cada
+        ``args.progress_every`` archivos y ejecuta recolección de basura +
+        ``store_shrink`` cada ``args.gc_every`` archivos.  Los volcados del
+        CSV y los commits de estado los hace el hilo escritor; aquí sólo se
+        propagan sus errores para detener el recorrido.  Al terminar fija
+        ``next_periodic``, de modo que cada umbral se atiende una sola vez
+        aunque se sigan omitiendo archivos sin procesar ninguno.
+        """
+        nonlocal next_periodic
+        next_periodic = next_periodic_at(local_processed)
+        if sink_errors:
+            raise sink_errors[0]
         if args.progress_every and local_processed % args.progress_every == 0:
             print(
                 f"Progreso: {processed} procesados | {skipped} omitidos | "
                 f"{errors_count} errores | PDFs [1={pdf_1}, 0={pdf_0}, ''={pdf_x}]"
             )
-            try:
-                if csv_fp:
-                    # writer no es file, necesitamos el archivo real para flush
-                    pass
-            except Exception:
-                pass
-            conn.commit()
         # Recolección de basura
         if args.gc_every > 0 and local_processed % args.gc_every == 0 and local_processed != 0:
             print("[GC] Liberación de memoria…")
             # Llamar store_shrink globalmente
-            if fitz is not None and hasattr(fitz, "TOOLS"):
+            if _store_shrink:
                 try:
-                    fitz.TOOLS.store_shrink(DEFAULT_STORE_SHRINK)
+                    _store_shrink(DEFAULT_STORE_SHRINK)
                 except Exception:
                     pass
             # Forzar recolección de basura
             gc.collect()
 
+    def collect_pdf(handle, wait_all: bool = False) -> None:
+        """
+        Entrega a ``handle(futuro, registro)`` los PDFs ya clasificados que
+        haya en ``result_q``.  Sin ``wait_all`` no espera; con ``wait_all``
+        bloquea hasta recoger todos los enviados.
+        """
+        nonlocal in_flight
+        while in_flight:
+            if wait_all:
+                item = result_q.get()
+            else:
+                try:
+                    item = result_q.get_nowait()
+                except queue.Empty:
+                    return
+            in_flight -= 1
+            handle(*item)
+
+    def pool_submit(path_abs: str, final: bool = False) -> concurrent.futures.Future:
+        """
+        Envía ``_classify_pdf_job`` al pool (``final`` para el segundo y
+        último intento); si el pool quedó inutilizable (un proceso hijo
+        murió), lo recrea y reenvía.
+        """
+        nonlocal executor, executor_auto_recycle
+        try:
+            return executor.submit(_classify_pdf_job, path_abs, pdf_pages, final)
+        except concurrent.futures.process.BrokenProcessPool:
+            log.error("Pool de procesos PDF roto; se recrea")
+            executor.shutdown(wait=False)
+            executor, executor_auto_recycle = make_pdf_executor(args.workers, store_maxsize)
+            return executor.submit(_classify_pdf_job, path_abs, pdf_pages, final)
+
+    def pool_result(rec: Tuple, final: bool = False) -> Optional[str]:
+        """
+        Clasifica en el pool, de forma aislada (nada más en vuelo), el PDF
+        del registro ``rec``; si vuelve a romper el pool queda indeterminado.
+        """
+        try:
+            flag, msgs = pool_submit(rec[0], final).result()
+            for msg in msgs:
+                logger.error(msg)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            logger.error(f"PDF rompe el pool de procesos {rec[0]}: {e!r}")
+            flag = ""
+        except Exception as e:
+            logger.error(f"Error en worker PDF {rec[0]}: {e!r}")
+            flag = ""
+        return flag
+
+    def retry_broken_pdfs(record) -> None:
+        """
+        Segundo intento, en el pool, de los PDFs de ``broken_queue``.  Al
+        morir un proceso hijo fallan todos los futuros del pool y no sólo el
+        del PDF culpable, así que cada uno se reenvía de uno en uno (con el
+        resto ya drenado) y sólo se da por indeterminado (``""``) el que
+        vuelve a romper el pool.  No se clasifican en el proceso principal:
+        un PDF que tumba a MuPDF tumbaría también al escáner.  El resultado
+        se entrega a ``record``.
+        """
+        for rec in broken_queue:
+            flag = pool_result(rec)
+            if flag is None:
+                retry_queue.append(rec)
+            else:
+                record(rec, flag)
+        broken_queue.clear()
+
+    def retry_failed_pdfs(record) -> None:
+        """
+        Segundo y último intento de los PDFs de ``retry_queue`` (su apertura
+        falló en la primera pasada).  Con pool se reenvían todos a la vez,
+        con ``final``, y conservan el aislamiento de procesos; si el pool se
+        rompe, los afectados se reintentan de uno en uno como en
+        ``retry_broken_pdfs``.  Sólo con ``--workers 1`` se clasifican en el
+        proceso principal.  El resultado se entrega a ``record``.
+        """
+        if executor is None:
+            for rec in retry_queue:
+                record(rec, retry_classify_pdf(rec[0], pdf_pages))
+            retry_queue.clear()
+            return
+        futs = [(pool_submit(rec[0], True), rec) for rec in retry_queue]
+        retry_queue.clear()
+        broken: List[Tuple] = []
+        for fut, rec in futs:
+            try:
+                flag, msgs = fut.result()
+                for msg in msgs:
+                    logger.error(msg)
+            except concurrent.futures.process.BrokenProcessPool:
+                broken.append(rec)
+                continue
+            except Exception as e:
+                logger.error(f"Error en worker PDF {rec[0]}: {e!r}")
+                flag = ""
+            record(rec, flag)
+        for rec in broken:
+            record(rec, pool_result(rec, True))
+
+    def submit_pdf(rec: Tuple, handle) -> None:
+        """
+        Envía al pool de procesos el PDF del registro ``rec`` (la ruta es
+        ``rec[0]``); al terminar, el futuro se encola en ``result_q`` con su
+        registro.  Antes de enviar toma un hueco de ``pdf_slots``, que se
+        libera al terminar el futuro: con ``workers * PDF_PENDING_PER_WORKER``
+        PDFs en el pool el recorrido se detiene aquí (contrapresión).
+        Después recoge los resultados ya disponibles.  Si el pool quedó
+        inutilizable (un proceso hijo murió), lo recrea (ver
+        ``pool_submit``); sin ``max_tasks_per_child`` (Python < 3.11) drena
+        los pendientes con ``handle`` y recicla el pool completo cada
+        ``PDF_TASKS_PER_CHILD * workers`` documentos.
+        """
+        nonlocal executor, executor_auto_recycle, pdf_submitted, in_flight
+        if not executor_auto_recycle and pdf_submitted and \
+                pdf_submitted % (PDF_TASKS_PER_CHILD * args.workers) == 0:
+            collect_pdf(handle, wait_all=True)
+            executor.shutdown(wait=True)
+            executor, executor_auto_recycle = make_pdf_executor(args.workers, store_maxsize)
+        pdf_submitted += 1
+        pdf_slots.acquire()
+        fut = pool_submit(rec[0])
+        in_flight += 1
+        fut.add_done_callback(lambda f: (result_q.put((f, rec)), pdf_slots.release()))
+        collect_pdf(handle)
+
     try:
-        if use_threads:
-            executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+        if use_pool:
+            executor, executor_auto_recycle = make_pdf_executor(args.workers, store_maxsize)
+        if (args.dir_workers or 1) > 1:
+            dir_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=args.dir_workers, thread_name_prefix="scandir")
 
         # ------------------------------------------------------------------
         # Modo ALL: un único CSV para todo el recorrido
@@ -664,8 +1463,8 @@ def main() -> None:
             # Preparar CSV único
             out_mode = "w" if (args.fresh or args.reset_state or not os.path.exists(args.out)) else "a"
             os.makedirs(os.path.dirname(args.out), exist_ok=True)
-            csv_fp = open(args.out, out_mode, newline="", encoding="utf-8")
-            csvw = csv.writer(csv_fp)
+            csv_fp = open(args.out, out_mode + "b", buffering=CSV_BUFFER_SIZE)
+            csvw = BufferedCsvWriter(csv_fp)
             base_header = [
                 "nombre del archivo", "extensión del archivo",
                 "tamaño del archivo en Kbytes", "tamaño del archivo en MBytes",
@@ -674,18 +1473,35 @@ def main() -> None:
             header = base_header + (["top_level_dir"] if args.add_topdir_col else [])
             if out_mode == "w":
                 # Escribir encabezado con manejo de permisos
-                safe_writerow(csvw, header, csv_fp, log)
-                csv_fp.flush()
+                csvw.writerow(header)
+                safe_flush(csvw, log)
+            start_sink(csvw)
+            # Columna opcional top_level_dir (vacía en modo 'all')
+            row_tail: Tuple[str, ...] = ("",) if args.add_topdir_col else ()
 
             # Handler para futuros PDF en modo 'all'
             def handle_pdf_future_all(fut: concurrent.futures.Future, rec: Tuple) -> None:
-                nonlocal processed, pdf_1, pdf_0, pdf_x, errors_count
-                (p_abs, name, ext, kb, mb, rel_path, st_size, st_mtime_ns, topdir_label) = rec
                 try:
-                    flag = fut.result()
+                    flag, msgs = fut.result()
+                    for msg in msgs:
+                        logger.error(msg)
+                except concurrent.futures.process.BrokenProcessPool:
+                    # Un proceso hijo murió: segundo intento aislado (``retry_broken_pdfs``)
+                    broken_queue.append(rec)
+                    return
                 except Exception as e:
-                    logging.getLogger("scan_ntfs").error(f"Error en worker PDF {p_abs}: {e!r}")
+                    logger.error(f"Error en worker PDF {rec[0]}: {e!r}")
                     flag = ""
+                if flag is None:
+                    # No se pudo abrir: segundo intento al final del recorrido
+                    retry_queue.append(rec)
+                    return
+                record_pdf_all(rec, flag)
+
+            # Registro de un PDF ya clasificado en modo 'all'
+            def record_pdf_all(rec: Tuple, flag: str) -> None:
+                nonlocal processed, pdf_1, pdf_0, pdf_x
+                (p_abs, name, ext, kb_s, mb_s, rel_path, st_size, st_mtime_ns) = rec
                 # Actualizar contadores por tipo
                 if flag == "1":
                     pdf_1 += 1
@@ -694,100 +1510,86 @@ def main() -> None:
                 else:
                     pdf_x += 1
                 # Escribir fila CSV
-                row: List[str] = [name, ext, f"{kb:.2f}", f"{mb:.2f}", rel_path, flag]
-                if args.add_topdir_col:
-                    row.append(topdir_label)
-                safe_writerow(csvw, row, csv_fp, log)
+                emit_row([name, ext, kb_s, mb_s, rel_path, flag, *row_tail],
+                         p_abs, st_size, st_mtime_ns)
                 processed += 1
-                try:
-                    upsert_state(conn, p_abs, st_size, st_mtime_ns)
-                except Exception as e:
-                    errors_count += 1
-                    logging.getLogger("scan_ntfs").error(f"Fallo upsert_state {p_abs}: {e!r}")
-                periodic_actions(None, processed)
+                if processed >= next_periodic:
+                    periodic_actions(processed)
 
             # Recorrido recursivo
-            for abs_path, rel_path in walk_files_under(root_path, exclude_dirs):
+            for abs_path, rel_path, fname, st_size, st_mtime_ns in walk_files_under(root_path, exclude_dirs, dir_executor, dir_inflight):
                 if abs_path is None:
                     errors_count += 1
-                    periodic_actions(None, processed)
+                    if processed >= next_periodic:
+                        periodic_actions(processed)
                     continue
-                # Obtener stat con reintentos
-                try:
-                    st = os.stat(abs_path)
-                except Exception as e:
-                    log.error(f"Error accediendo a {abs_path}: {e!r}")
-                    time.sleep(random.uniform(0.2, 0.5))
-                    try:
-                        st = os.stat(abs_path)
-                    except Exception as e2:
-                        log.error(f"Fallo definitivo accediendo a {abs_path}: {e2!r}")
+                # Sólo si la enumeración no aportó tamaño/fecha se usa os.stat
+                if st_size is None:
+                    st_size, st_mtime_ns = stat_with_retry(abs_path, log)
+                    if st_size is None:
                         errors_count += 1
-                        periodic_actions(None, processed)
+                        if processed >= next_periodic:
+                            periodic_actions(processed)
                         continue
                 # Saltar si ya está procesado (salvo --fresh)
-                if not args.fresh and already_processed(conn, abs_path, st.st_size, st.st_mtime_ns):
+                if is_processed is not None and is_processed(abs_path, st_size, st_mtime_ns):
                     skipped += 1
-                    periodic_actions(None, processed)
+                    if processed >= next_periodic:
+                        periodic_actions(processed)
                     continue
+                # Nombre (``DirEntry.name``) y extensión con un solo ``rpartition``;
+                # como ``splitext``, los puntos iniciales (".bashrc") no son extensión
+                name_noext, _, ext = fname.rpartition(".")
+                if name_noext.strip("."):
+                    ext = ext.lower()
+                else:
+                    name_noext, ext = fname, ""
                 # Filtrar por extensión
-                name = os.path.basename(abs_path)
-                name_noext, ext = os.path.splitext(name)
-                ext = ext[1:].lower() if ext else ""
                 if include_exts and ext not in include_exts:
-                    periodic_actions(None, processed)
+                    if processed >= next_periodic:
+                        periodic_actions(processed)
                     continue
                 if exclude_exts and ext in exclude_exts:
-                    periodic_actions(None, processed)
+                    if processed >= next_periodic:
+                        periodic_actions(processed)
                     continue
-                if args.limit and processed >= args.limit:
-                    break
-                kb, mb = bytes_to_kb_mb(st.st_size)
-                # Clasificación PDF
-                if ext == "pdf":
-                    if use_threads:
-                        fut = executor.submit(classify_pdf, abs_path, args.pdf_pages)
-                        pending[fut] = (abs_path, name_noext, ext, kb, mb, rel_path, st.st_size, st.st_mtime_ns, "")
-                        # Drenar futuros si se acumulan
-                        if len(pending) >= (args.workers or 1) * 5:
-                            done, _ = concurrent.futures.wait(list(pending.keys()), return_when=concurrent.futures.FIRST_COMPLETED)
-                            for f in done:
-                                rec = pending.pop(f)
-                                handle_pdf_future_all(f, rec)
-                            csv_fp.flush(); conn.commit()
+                admitted += 1
+                # Tamaños en KB y MB, formateados una sola vez para el CSV
+                kb_s = f"{st_size / 1024:.2f}"
+                mb_s = f"{st_size / 1048576:.2f}"
+                # Clasificación PDF (sólo si PyMuPDF está disponible; el resto
+                # de archivos se escribe directamente sin pasar por el pool)
+                if ext == "pdf" and fitz is not None:
+                    if use_pool:
+                        submit_pdf((abs_path, name_noext, ext, kb_s, mb_s, rel_path, st_size, st_mtime_ns),
+                                   handle_pdf_future_all)
                     else:
-                        flag = classify_pdf(abs_path, args.pdf_pages)
-                        if flag == "1":
-                            pdf_1 += 1
-                        elif flag == "0":
-                            pdf_0 += 1
+                        rec = (abs_path, name_noext, ext, kb_s, mb_s, rel_path, st_size, st_mtime_ns)
+                        try:
+                            flag = classify_pdf(abs_path, pdf_pages)
+                        except Exception:
+                            retry_queue.append(rec)
                         else:
-                            pdf_x += 1
-                        row = [name_noext, ext, f"{kb:.2f}", f"{mb:.2f}", rel_path, flag]
-                        if args.add_topdir_col:
-                            row.append("")
-                        safe_writerow(csvw, row, csv_fp, log)
-                        processed += 1
-                        upsert_state(conn, abs_path, st.st_size, st.st_mtime_ns)
-                        periodic_actions(None, processed)
+                            record_pdf_all(rec, flag)
                 else:
-                    row = [name_noext, ext, f"{kb:.2f}", f"{mb:.2f}", rel_path, ""]
-                    if args.add_topdir_col:
-                        row.append("")
-                    safe_writerow(csvw, row, csv_fp, log)
+                    if ext == "pdf":
+                        # Sin PyMuPDF el PDF queda indeterminado
+                        pdf_x += 1
+                    emit_row([name_noext, ext, kb_s, mb_s, rel_path, "", *row_tail],
+                             abs_path, st_size, st_mtime_ns)
                     processed += 1
-                    upsert_state(conn, abs_path, st.st_size, st.st_mtime_ns)
-                    periodic_actions(None, processed)
+                    if processed >= next_periodic:
+                        periodic_actions(processed)
+                # Con el límite alcanzado no se enumera ni se consulta nada más
+                if admitted == limit:
+                    break
             # Drenar futuros restantes en modo 'all'
-            if use_threads and pending:
-                for f in concurrent.futures.as_completed(list(pending.keys())):
-                    rec = pending.pop(f)
-                    handle_pdf_future_all(f, rec)
-            # Flush final y commit
-            try:
-                csv_fp.flush()
-            except Exception:
-                pass
+            collect_pdf(handle_pdf_future_all, wait_all=True)
+            retry_broken_pdfs(record_pdf_all)
+            # Segundo intento de los PDFs que no se pudieron abrir
+            retry_failed_pdfs(record_pdf_all)
+            # Esperar al hilo escritor (flush final) y confirmar su último lote
+            stop_sink()
             conn.commit()
             try:
                 csv_fp.close()
@@ -809,16 +1611,16 @@ def main() -> None:
                     print(f"[{topdir}] ya finalizado anteriormente. Saltando…")
                     continue
                 # Verificar existencia
-                topdir_root = os.path.join(root_path, topdir)
-                if not os.path.isdir(topdir_root):
+                topdir_root = normalize_path(os.path.join(root_path, topdir))
+                if not topdir_root or not os.path.isdir(topdir_root):
                     print(f"[{topdir}] no existe o no es directorio. Saltando…")
                     continue
                 # Determinar CSV por topdir
                 out_csv = compute_out_csv(args.out, topdir)
                 os.makedirs(os.path.dirname(out_csv), exist_ok=True)
                 out_mode = "w" if (args.fresh or args.reset_state or not os.path.exists(out_csv)) else "a"
-                csv_file = open(out_csv, out_mode, newline="", encoding="utf-8")
-                csvw = csv.writer(csv_file)
+                csv_file = open(out_csv, out_mode + "b", buffering=CSV_BUFFER_SIZE)
+                csvw = BufferedCsvWriter(csv_file)
                 base_header = [
                     "nombre del archivo", "extensión del archivo",
                     "tamaño del archivo en Kbytes", "tamaño del archivo en MBytes",
@@ -827,8 +1629,11 @@ def main() -> None:
                 header = base_header + (["top_level_dir"] if args.add_topdir_col else [])
                 if out_mode == "w":
                     # Escribir encabezado con manejo de permisos
-                    safe_writerow(csvw, header, csv_file, log)
-                    csv_file.flush()
+                    csvw.writerow(header)
+                    safe_flush(csvw, log)
+                start_sink(csvw)
+                # Columna opcional top_level_dir
+                row_tail = (topdir,) if args.add_topdir_col else ()
                 # Contadores por topdir
                 td_processed = 0
                 td_skipped = 0
@@ -840,113 +1645,116 @@ def main() -> None:
                 print(f"== Iniciando topdir: {topdir} ==")
                 # Handler para futuros en este topdir
                 def handle_pdf_future_td(fut: concurrent.futures.Future, rec: Tuple) -> None:
-                    nonlocal processed, pdf_1, pdf_0, pdf_x, errors_count
-                    # Declarar también td_errors y td_skipped para modificarlos dentro del closure
-                    nonlocal td_processed, td_pdf1, td_pdf0, td_pdfx, td_errors, td_skipped
-                    (p_abs, name, ext_, kb, mb, rel_path, st_size, st_mtime_ns, topdir_label) = rec
                     try:
-                        flag = fut.result()
+                        flag, msgs = fut.result()
+                        for msg in msgs:
+                            logger.error(msg)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        # Un proceso hijo murió: segundo intento aislado (``retry_broken_pdfs``)
+                        broken_queue.append(rec)
+                        return
                     except Exception as e:
-                        logging.getLogger("scan_ntfs").error(f"Error en worker PDF {p_abs}: {e!r}")
+                        logger.error(f"Error en worker PDF {rec[0]}: {e!r}")
                         flag = ""
+                    if flag is None:
+                        # No se pudo abrir: segundo intento al final del topdir
+                        retry_queue.append(rec)
+                        return
+                    record_pdf_td(rec, flag)
+
+                # Registro de un PDF ya clasificado en este topdir
+                def record_pdf_td(rec: Tuple, flag: str) -> None:
+                    nonlocal processed, pdf_1, pdf_0, pdf_x
+                    nonlocal td_processed, td_pdf1, td_pdf0, td_pdfx
+                    (p_abs, name, ext_, kb_s, mb_s, rel_path, st_size, st_mtime_ns) = rec
                     if flag == "1":
                         pdf_1 += 1; td_pdf1 += 1
                     elif flag == "0":
                         pdf_0 += 1; td_pdf0 += 1
                     else:
                         pdf_x += 1; td_pdfx += 1
-                    row2: List[str] = [name, ext_, f"{kb:.2f}", f"{mb:.2f}", rel_path, flag]
-                    if args.add_topdir_col:
-                        row2.append(topdir_label)
-                    safe_writerow(csvw, row2, csv_file, log)
+                    emit_row([name, ext_, kb_s, mb_s, rel_path, flag, *row_tail],
+                             p_abs, st_size, st_mtime_ns)
                     processed += 1; td_processed += 1
-                    try:
-                        upsert_state(conn, p_abs, st_size, st_mtime_ns)
-                    except Exception as e:
-                        errors_count += 1; td_errors += 1
-                        logging.getLogger("scan_ntfs").error(f"Fallo upsert_state {p_abs}: {e!r}")
-                    periodic_actions(None, processed)
+                    if processed >= next_periodic:
+                        periodic_actions(processed)
                 # Recorrido de archivos del topdir
-                for abs_path, rel_path in walk_files_under(topdir_root, exclude_dirs):
+                for abs_path, rel_path, fname, st_size, st_mtime_ns in walk_files_under(topdir_root, exclude_dirs, dir_executor, dir_inflight):
                     if abs_path is None:
                         errors_count += 1; td_errors += 1
-                        periodic_actions(None, processed)
+                        if processed >= next_periodic:
+                            periodic_actions(processed)
                         continue
-                    # stat con reintentos
-                    try:
-                        st = os.stat(abs_path)
-                    except Exception as e:
-                        log.error(f"[{topdir}] Error accediendo a {abs_path}: {e!r}")
-                        time.sleep(random.uniform(0.2, 0.5))
-                        try:
-                            st = os.stat(abs_path)
-                        except Exception as e2:
-                            log.error(f"[{topdir}] Fallo definitivo accediendo a {abs_path}: {e2!r}")
+                    # Sólo si la enumeración no aportó tamaño/fecha se usa os.stat
+                    if st_size is None:
+                        st_size, st_mtime_ns = stat_with_retry(abs_path, log, f"[{topdir}] ")
+                        if st_size is None:
                             errors_count += 1; td_errors += 1
-                            periodic_actions(None, processed)
+                            if processed >= next_periodic:
+                                periodic_actions(processed)
                             continue
                     # Omitir si ya procesado (salvo fresh)
-                    if not args.fresh and already_processed(conn, abs_path, st.st_size, st.st_mtime_ns):
+                    if is_processed is not None and is_processed(abs_path, st_size, st_mtime_ns):
                         skipped += 1; td_skipped += 1
-                        periodic_actions(None, processed)
+                        if processed >= next_periodic:
+                            periodic_actions(processed)
                         continue
-                    fname = os.path.basename(abs_path)
-                    name_noext, ext = os.path.splitext(fname)
-                    ext = ext[1:].lower() if ext else ""
+                    # Nombre (``DirEntry.name``) y extensión con un solo ``rpartition``;
+                    # como ``splitext``, los puntos iniciales (".bashrc") no son extensión
+                    name_noext, _, ext = fname.rpartition(".")
+                    if name_noext.strip("."):
+                        ext = ext.lower()
+                    else:
+                        name_noext, ext = fname, ""
                     if include_exts and ext not in include_exts:
-                        periodic_actions(None, processed)
+                        if processed >= next_periodic:
+                            periodic_actions(processed)
                         continue
                     if exclude_exts and ext in exclude_exts:
-                        periodic_actions(None, processed)
+                        if processed >= next_periodic:
+                            periodic_actions(processed)
                         continue
-                    if args.limit and processed >= args.limit:
-                        break
-                    kb, mb = bytes_to_kb_mb(st.st_size)
-                    if ext == "pdf":
-                        if use_threads:
-                            fut = executor.submit(classify_pdf, abs_path, args.pdf_pages)
-                            pending[fut] = (abs_path, name_noext, ext, kb, mb, rel_path, st.st_size, st.st_mtime_ns, topdir)
-                            if len(pending) >= (args.workers or 1) * 5:
-                                done, _ = concurrent.futures.wait(list(pending.keys()), return_when=concurrent.futures.FIRST_COMPLETED)
-                                for f in done:
-                                    rec = pending.pop(f)
-                                    handle_pdf_future_td(f, rec)
-                                csv_file.flush(); conn.commit()
+                    admitted += 1
+                    # Tamaños en KB y MB, formateados una sola vez para el CSV
+                    kb_s = f"{st_size / 1024:.2f}"
+                    mb_s = f"{st_size / 1048576:.2f}"
+                    if ext == "pdf" and fitz is not None:
+                        if use_pool:
+                            submit_pdf((abs_path, name_noext, ext, kb_s, mb_s, rel_path, st_size, st_mtime_ns),
+                                       handle_pdf_future_td)
                         else:
-                            flag = classify_pdf(abs_path, args.pdf_pages)
-                            if flag == "1":
-                                pdf_1 += 1; td_pdf1 += 1
-                            elif flag == "0":
-                                pdf_0 += 1; td_pdf0 += 1
+                            rec = (abs_path, name_noext, ext, kb_s, mb_s, rel_path, st_size, st_mtime_ns)
+                            try:
+                                flag = classify_pdf(abs_path, pdf_pages)
+                            except Exception:
+                                retry_queue.append(rec)
                             else:
-                                pdf_x += 1; td_pdfx += 1
-                            row3 = [name_noext, ext, f"{kb:.2f}", f"{mb:.2f}", rel_path, flag]
-                            if args.add_topdir_col:
-                                row3.append(topdir)
-                            safe_writerow(csvw, row3, csv_file, log)
-                            processed += 1; td_processed += 1
-                            upsert_state(conn, abs_path, st.st_size, st.st_mtime_ns)
-                            periodic_actions(None, processed)
+                                record_pdf_td(rec, flag)
                     else:
-                        row3 = [name_noext, ext, f"{kb:.2f}", f"{mb:.2f}", rel_path, ""]
-                        if args.add_topdir_col:
-                            row3.append(topdir)
-                        safe_writerow(csvw, row3, csv_file, log)
+                        if ext == "pdf":
+                            # Sin PyMuPDF el PDF queda indeterminado
+                            pdf_x += 1; td_pdfx += 1
+                        emit_row([name_noext, ext, kb_s, mb_s, rel_path, "", *row_tail],
+                                 abs_path, st_size, st_mtime_ns)
                         processed += 1; td_processed += 1
-                        upsert_state(conn, abs_path, st.st_size, st.st_mtime_ns)
-                        periodic_actions(None, processed)
+                        if processed >= next_periodic:
+                            periodic_actions(processed)
+                    # Con el límite alcanzado no se enumera ni se consulta nada más
+                    if admitted == limit:
+                        limit_hit = True
+                        break
                 # Drenar futuros al finalizar subcarpeta
-                if use_threads and pending:
-                    for f in concurrent.futures.as_completed(list(pending.keys())):
-                        rec = pending.pop(f)
-                        handle_pdf_future_td(f, rec)
-                try:
-                    csv_file.flush()
-                except Exception:
-                    pass
-                conn.commit()
-                # Marcar subcarpeta como finalizada
-                mark_topdir_finished(conn, topdir)
+                collect_pdf(handle_pdf_future_td, wait_all=True)
+                retry_broken_pdfs(record_pdf_td)
+                # Segundo intento de los PDFs que no se pudieron abrir
+                retry_failed_pdfs(record_pdf_td)
+                stop_sink()
+                if limit_hit:
+                    # Recorrido cortado por --limit: la carpeta queda pendiente
+                    conn.commit()
+                else:
+                    # Marcar subcarpeta como finalizada (mismo commit que el último lote)
+                    mark_topdir_finished(conn, topdir)
                 # Resumen por topdir
                 td_elapsed = time.time() - td_start
                 td_rate = ((td_processed + td_skipped + td_errors) / td_elapsed) if td_elapsed > 0 else 0.0
@@ -959,15 +1767,12 @@ def main() -> None:
                     csv_file.close()
                 except Exception:
                     pass
+                if limit_hit:
+                    break
         # Fin else modo per-topdir
 
-        # Drenaje final de futuros pendientes
-        if use_threads and pending:
-            for f in concurrent.futures.as_completed(list(pending.keys())):
-                try:
-                    _ = f.result()
-                except Exception:
-                    pass
+        # Drenaje final de futuros pendientes (sus resultados se descartan)
+        collect_pdf(lambda f, rec: None, wait_all=True)
     finally:
         # Cierre ordenado de recursos comunes
         try:
@@ -975,6 +1780,17 @@ def main() -> None:
                 executor.shutdown(wait=True)
         except Exception:
             pass
+        try:
+            if dir_executor is not None:
+                dir_executor.shutdown(wait=True)
+        except Exception:
+            pass
+        try:
+            # El hilo escritor vuelca lo ya encolado; si su volcado del CSV
+            # falla no registra el estado pendiente
+            stop_sink()
+        except Exception:
+            pass
         try:
             conn.commit()
         except Exception:
@@ -983,6 +1799,11 @@ def main() -> None:
             conn.close()
         except Exception:
             pass
+        if lookup_conn is not None:
+            try:
+                lookup_conn.close()
+            except Exception:
+                pass
         # Tiempo total y resumen global
         elapsed = time.time() - start_time
         h = int(elapsed // 3600)